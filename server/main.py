@@ -1,17 +1,33 @@
 import io
+import os
+import asyncio
 import sys
 import hashlib
-from typing import List, Optional
-from fastapi import FastAPI, File, UploadFile, HTTPException
+import hmac
+import re
+from typing import List, Literal, Optional, get_args
+from urllib.parse import quote
+from fastapi import FastAPI, File, Form, Header, Request, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
-from mido import MidiFile, MidiTrack, Message
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, ValidationError
+from anyio import to_thread
+from mido import MidiFile
+import numpy as np
+import orjson
+import msgspec
+import gmpy2
+from blake3 import blake3
 import qrcode
 from PIL import Image, ImageDraw, ImageFont
 from pyzbar import pyzbar
 import base64
 
+try:
+    import pybase64  # SIMD base64 codec
+except ImportError:
+    pybase64 = None
+
 # Set unlimited integer string conversion
 sys.set_int_max_str_digits(0)
 
@@ -26,11 +42,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Pydantic models
+# Request/response models
 class PrimeRequest(BaseModel):
     prime_string: str
 
-class QRDecodeRequest(BaseModel):
+class QRDecodeRequest(msgspec.Struct):
+    # Decoded with msgspec rather than pydantic: image_data can be a
+    # multi-MB base64 string
     image_data: str  # base64 encoded image
 
 class VerificationRequest(BaseModel):
@@ -44,17 +62,98 @@ class VerificationResponse(BaseModel):
 class PipelineStep(BaseModel):
     operation: str  # 'encode_midi', 'encode_prime', 'encode_qr', 'decode_midi', etc.
     parameters: dict = {}
+    # Index of the step whose output feeds this one; None chains from the
+    # previous step and -1 reads the uploaded file
+    input: Optional[int] = None
 
 class PipelineRequest(BaseModel):
     steps: List[PipelineStep]
 
+# MIDI encoding modes: raw data notes, or data notes plus accompaniment
+MidiMode = Literal["raw", "musical"]
+
+# MIDI constants for the encoder's Standard MIDI File writer
+MIDI_TICKS_PER_BEAT = 480
+MIDI_NOTE_GAP = 120  # ticks between consecutive data notes
+BASS_NOTE_LENGTH = 480
+CHORD_NOTE_LENGTH = 240
+DRUM_NOTE_LENGTH = 100
+MIDI_END_OF_TRACK = b'\x00\xff\x2f\x00'
+
+# Prime string representations; decimal strings stay untagged for compatibility
+PrimeRepresentation = Literal["decimal", "hex", "base64"]
+PRIME_HEX_PREFIX = "0x"
+PRIME_BASE64_PREFIX = "B64:"
+
+# Below ~128 bytes (~300 digits) CPython's own int/str conversion beats the
+# cost of round-tripping through gmpy2.mpz
+PRIME_GMP_MIN_BYTES = 128
+PRIME_GMP_MIN_DIGITS = 300
+
+# Integrity hash: SHA-256 by default so existing client-stored hashes keep
+# matching; set TRANSCODE_HASH_ALGORITHM=blake3 for the faster SIMD hasher.
+# Both produce 64-character hex digests.
+HASH_ALGORITHM = os.environ.get("TRANSCODE_HASH_ALGORITHM", "sha256").lower()
+if HASH_ALGORITHM not in ("sha256", "blake3"):
+    raise RuntimeError(f"Unsupported TRANSCODE_HASH_ALGORITHM: {HASH_ALGORITHM}")
+
+# Uploads are read in 1 MiB chunks so hashing overlaps with I/O
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# QR payloads beyond this size cannot be encoded
+QR_MAX_UPLOAD_BYTES = 500 * 1024
+
 # Utility Functions
+def new_hasher(data: bytes = b""):
+    """Create an incremental hasher for the configured integrity algorithm"""
+    if HASH_ALGORITHM == "blake3":
+        return blake3(data, max_threads=blake3.AUTO)
+    return hashlib.sha256(data)
+
 def calculate_hash(data: bytes) -> str:
-    """Calculate SHA-256 hash of data"""
-    return hashlib.sha256(data).hexdigest()
+    """Calculate integrity hash of data"""
+    return new_hasher(data).hexdigest()
 
-def bytes_to_prime_string(data: bytes, filename: str = "") -> str:
-    """Convert bytes to a large decimal string with metadata"""
+def b64encode_str(data: bytes) -> str:
+    """Base64-encode bytes to a str, using pybase64 when available"""
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode('ascii')
+
+def b64decode(data: str, validate: bool = False) -> bytes:
+    """Decode a base64 str, using pybase64 when available"""
+    if pybase64 is not None:
+        return pybase64.b64decode(data, validate=validate)
+    return base64.b64decode(data, validate=validate)
+
+def content_disposition(filename: str) -> str:
+    """Build an attachment Content-Disposition header that is safe for any filename"""
+    # Header values must be Latin-1 and the quoted name cannot hold quotes or
+    # backslashes, so such names get an ASCII fallback plus an RFC 5987 UTF-8 form
+    fallback = re.sub(r'[^\x20-\x7e]|["\\]', '_', filename)
+    if fallback == filename:
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+async def read_upload(file: UploadFile, max_size: Optional[int] = None, purpose: str = "upload") -> tuple[bytes, str]:
+    """Read an upload in chunks, hashing each chunk as it arrives"""
+    hasher = new_hasher()
+    chunks = []
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if max_size is not None and size > max_size:
+            raise HTTPException(status_code=400, detail=f"File too large for {purpose} (max {max_size // 1024}KB)")
+        hasher.update(chunk)
+        chunks.append(chunk)
+    
+    if not size:
+        raise HTTPException(status_code=400, detail="File is empty")
+    
+    return b"".join(chunks), hasher.hexdigest()
+
+def bytes_to_prime_string(data: bytes, filename: str = "", representation: PrimeRepresentation = "base64") -> str:
+    """Convert bytes to a decimal, hex or base64 string with metadata"""
     # Fixed-length header format:
     # [4 bytes: filename length][filename bytes][4 bytes: data length][binary data]
     
@@ -70,22 +169,33 @@ def bytes_to_prime_string(data: bytes, filename: str = "") -> str:
     )
     
     full_data = header + data
-    # Convert to integer (big-endian)
-    big_int = int.from_bytes(full_data, byteorder='big')
+    if representation == "base64":
+        return PRIME_BASE64_PREFIX + b64encode_str(full_data)
+    if representation == "hex":
+        return PRIME_HEX_PREFIX + full_data.hex()
     
-    try:
+    # Convert to integer (big-endian); GMP's sub-quadratic base conversion
+    # keeps the decimal string affordable for large files
+    big_int = int.from_bytes(full_data, byteorder='big')
+    if len(full_data) < PRIME_GMP_MIN_BYTES:
         return str(big_int)
-    except ValueError as e:
-        # If still too large, use hex representation instead
-        return big_int.hex()
+    return gmpy2.digits(gmpy2.mpz(big_int), 10)
 
 def prime_string_to_bytes(prime_str: str) -> tuple[bytes, str]:
     """Convert prime string back to bytes and extract filename"""
     try:
-        big_int = int(prime_str)
-        # Convert back to bytes
-        byte_length = (big_int.bit_length() + 7) // 8
-        full_data = big_int.to_bytes(byte_length, byteorder='big')
+        if prime_str.startswith(PRIME_BASE64_PREFIX):
+            full_data = b64decode(prime_str[len(PRIME_BASE64_PREFIX):], validate=True)
+        elif prime_str.startswith(PRIME_HEX_PREFIX):
+            full_data = bytes.fromhex(prime_str[len(PRIME_HEX_PREFIX):])
+        else:
+            if len(prime_str) < PRIME_GMP_MIN_DIGITS:
+                big_int = int(prime_str)
+            else:
+                big_int = int(gmpy2.mpz(prime_str, 10))
+            # Convert back to bytes
+            byte_length = (big_int.bit_length() + 7) // 8
+            full_data = big_int.to_bytes(byte_length, byteorder='big')
         
         # Try new fixed-length header format first
         # [4 bytes: filename length][filename bytes][4 bytes: data length][binary data]
@@ -126,50 +236,255 @@ def prime_string_to_bytes(prime_str: str) -> tuple[bytes, str]:
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid prime string: {str(e)}")
 
-def add_musical_tracks(mid: MidiFile, data_track: MidiTrack) -> None:
-    """Add harmony, bass, and drum tracks to MIDI file"""
-    # Bass track (Track 2)
-    bass_track = MidiTrack()
-    mid.tracks.append(bass_track)
-    bass_track.append(Message('program_change', channel=1, program=32))  # Bass sound
-    
-    # Chord track (Track 3)
-    chord_track = MidiTrack()
-    mid.tracks.append(chord_track)
-    chord_track.append(Message('program_change', channel=2, program=0))  # Piano
-    
-    # Drum track (Track 4)
-    drum_track = MidiTrack()
-    mid.tracks.append(drum_track)
-    
-    # Add simple accompaniment based on data patterns
-    time = 0
-    for i, msg in enumerate(data_track):
-        if msg.type == 'note_on':
-            note = msg.note
-            velocity = msg.velocity
-            
-            # Bass line (root notes)
-            bass_note = (note % 12) + 36  # Bass range
-            bass_track.append(Message('note_on', channel=1, note=bass_note, velocity=velocity//2, time=time))
-            bass_track.append(Message('note_off', channel=1, note=bass_note, velocity=velocity//2, time=480))
-            
-            # Simple chord (triad)
-            chord_notes = [note, (note + 4) % 128, (note + 7) % 128]
-            for chord_note in chord_notes:
-                chord_track.append(Message('note_on', channel=2, note=chord_note, velocity=velocity//3, time=0))
-            for chord_note in chord_notes:
-                chord_track.append(Message('note_off', channel=2, note=chord_note, velocity=velocity//3, time=240))
-            
-            # Simple drum pattern
-            if i % 4 == 0:  # Kick on beats 1 and 3
-                drum_track.append(Message('note_on', channel=9, note=36, velocity=100, time=time))
-                drum_track.append(Message('note_off', channel=9, note=36, velocity=100, time=100))
-            if i % 4 == 2:  # Snare on beats 2 and 4
-                drum_track.append(Message('note_on', channel=9, note=38, velocity=80, time=time))
-                drum_track.append(Message('note_off', channel=9, note=38, velocity=80, time=100))
+def bytes_to_notes(data: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Map a uint8 array of data bytes to MIDI note and velocity arrays"""
+    notes = 48 + (data & 63)  # Limit to 64 note range
+    velocities = np.clip(40 + (data >> 2), 40, 127)  # Variable velocity
+    return notes, velocities
+
+def notes_to_bytes(notes: np.ndarray, velocities: np.ndarray) -> bytes:
+    """Recover data bytes from int16 MIDI note and velocity arrays"""
+    note_part = (notes - 48) & 63
+    velocity_part = np.clip((velocities - 40) << 2, 0, 192)
+    return ((note_part + velocity_part) & 0xFF).astype(np.uint8).tobytes()
+
+def encode_vlq(value: int) -> bytes:
+    """Encode a MIDI delta time as a variable-length quantity"""
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(reversed(out))
+
+def _event_rows(count: int, columns: list) -> bytes:
+    """Lay out one fixed-size run of MIDI events per data byte.
+    
+    Each column is either a constant byte or an array with one value per row.
+    """
+    rows = np.empty((count, len(columns)), dtype=np.uint8)
+    for i, column in enumerate(columns):
+        rows[:, i] = column
+    return rows.tobytes()
+
+def _note_starts(count: int) -> np.ndarray:
+    """Delta times for each data note: immediate for the first, then the note gap"""
+    starts = np.full(count, MIDI_NOTE_GAP, dtype=np.uint8)
+    starts[:1] = 0
+    return starts
+
+def midi_file_bytes(*tracks: bytes) -> bytes:
+    """Wrap encoded track events in a format 1 Standard MIDI File"""
+    header = (
+        b'MThd' +
+        (6).to_bytes(4, byteorder='big') +
+        (1).to_bytes(2, byteorder='big') +  # Format 1, matching mido's default
+        len(tracks).to_bytes(2, byteorder='big') +
+        MIDI_TICKS_PER_BEAT.to_bytes(2, byteorder='big')
+    )
+    chunks = [header]
+    for events in tracks:
+        track_data = events + MIDI_END_OF_TRACK
+        chunks.append(b'MTrk' + len(track_data).to_bytes(4, byteorder='big') + track_data)
+    return b''.join(chunks)
+
+def _data_track(notes: np.ndarray, velocities: np.ndarray) -> bytes:
+    # Per byte: [delta, 0x90, note, vel, delta, 0x80, note, vel]
+    return _event_rows(len(notes), [
+        _note_starts(len(notes)), 0x90, notes, velocities,
+        MIDI_NOTE_GAP, 0x80, notes, velocities,
+    ])
+
+def notes_to_midi_bytes(notes: np.ndarray, velocities: np.ndarray) -> bytes:
+    """Build a single-track Standard MIDI File from note/velocity arrays.
+    
+    Produces the same bytes as saving the equivalent mido track: every byte
+    becomes a note_on/note_off pair, and since all delta times fit in a
+    single variable-length-quantity byte each pair is a fixed 8-byte event.
+    """
+    return midi_file_bytes(_data_track(notes, velocities))
+
+def musical_midi_bytes(notes: np.ndarray, velocities: np.ndarray) -> bytes:
+    """Build the data track plus bass, chord and drum accompaniment tracks.
+    
+    Produces the same bytes mido saved for the Message-based accompaniment:
+    every data note gets a bass note, a triad and an alternating kick/snare
+    hit, each a fixed-size run of events. The triad's repeated note_on and
+    note_off statuses use running status, as mido writes them.
+    """
+    count = len(notes)
+    starts = _note_starts(count)
+    
+    # Bass line (root notes): [delta, 0x91, note, vel, 480, 0x81, note, vel]
+    bass_notes = (notes % 12) + 36  # Bass range
+    bass_velocities = velocities // 2
+    bass_track = b'\x00\xc1\x20' + _event_rows(count, [  # Bass sound (program 32)
+        starts, 0x91, bass_notes, bass_velocities,
+        *encode_vlq(BASS_NOTE_LENGTH), 0x81, bass_notes, bass_velocities,
+    ])
+    
+    # Simple chord (triad): three note_ons at delta 0, then three note_offs
+    chord_notes = [notes, (notes + 4) % 128, (notes + 7) % 128]
+    chord_velocities = velocities // 3
+    chord_off = encode_vlq(CHORD_NOTE_LENGTH)
+    chord_track = b'\x00\xc2\x00' + _event_rows(count, [  # Piano (program 0)
+        0, 0x92, chord_notes[0], chord_velocities,
+        0, chord_notes[1], chord_velocities,
+        0, chord_notes[2], chord_velocities,
+        *chord_off, 0x82, chord_notes[0], chord_velocities,
+        *chord_off, chord_notes[1], chord_velocities,
+        *chord_off, chord_notes[2], chord_velocities,
+    ])
+    
+    # Simple drum pattern: kick on beats 1 and 3, snare on beats 2 and 4
+    snare = (np.arange(count) & 1).astype(bool)
+    drum_notes = np.where(snare, 38, 36)
+    drum_velocities = np.where(snare, 80, 100)
+    drum_track = _event_rows(count, [
+        starts, 0x99, drum_notes, drum_velocities,
+        DRUM_NOTE_LENGTH, 0x89, drum_notes, drum_velocities,
+    ])
+    
+    return midi_file_bytes(_data_track(notes, velocities), bass_track, chord_track, drum_track)
+
+def parse_encoded_track(content: bytes) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    """Read note/velocity arrays from a MIDI file's first track without mido.
+    
+    Only handles the fixed 8-byte note_on/note_off layout written by the
+    encoder (raw or musical mode); returns None for any other file.
+    """
+    view = memoryview(content)
+    if len(view) < 14 or view[0:4] != b'MThd':
+        return None
+    header_len = int.from_bytes(view[4:8], byteorder='big')
+    track_count = int.from_bytes(view[10:12], byteorder='big') if header_len >= 6 else 0
+    track_start = 8 + header_len
+    if track_count < 1 or view[track_start:track_start + 4] != b'MTrk':
+        return None
+    
+    track_len = int.from_bytes(view[track_start + 4:track_start + 8], byteorder='big')
+    data_start = track_start + 8
+    events_len = track_len - len(MIDI_END_OF_TRACK)
+    if (events_len < 0 or events_len % 8 or data_start + track_len > len(view) or
+            view[data_start + events_len:data_start + track_len] != MIDI_END_OF_TRACK):
+        return None
+    
+    events = np.frombuffer(view, dtype=np.uint8, count=events_len, offset=data_start).reshape(-1, 8)
+    # Single-byte delta times and data bytes, with explicit note_on/note_off statuses
+    if not ((events[:, 1] == 0x90).all() and (events[:, 5] == 0x80).all() and
+            (events[:, [0, 2, 3, 4, 6, 7]] < 0x80).all()):
+        return None
+    
+    return events[:, 2].astype(np.int16), events[:, 3].astype(np.int16)
+
+def qr_matrix_to_image(matrix: List[List[bool]], box_size: int) -> Image.Image:
+    """Render a QR module matrix as a black-on-white 1-bit image.
+    
+    Scales the matrix with NumPy instead of qrcode's PIL factory, which
+    draws every dark module as a separate rectangle.
+    """
+    light = ~np.array(matrix, dtype=bool)
+    pixels = np.repeat(np.repeat(light, box_size, axis=0), box_size, axis=1)
+    return Image.fromarray(pixels)
+
+# Codecs shared by the endpoints and the pipeline
+def encode_midi_bytes(content: bytes, mode: MidiMode = "raw") -> bytes:
+    """Encode bytes as a Standard MIDI File, optionally with accompaniment"""
+    # Map bytes (0-255) to MIDI notes (48-111, C3-D#7) and velocities in one
+    # pass, then write the Standard MIDI File bytes directly
+    notes, velocities = bytes_to_notes(np.frombuffer(content, dtype=np.uint8))
+    if mode == "musical":
+        return musical_midi_bytes(notes, velocities)
+    return notes_to_midi_bytes(notes, velocities)
+
+def decode_midi_bytes(content: bytes) -> bytes:
+    """Recover the original bytes from an encoded MIDI file"""
+    # Files from /encode/midi are read straight from the raw bytes;
+    # anything else goes through mido's full parser
+    parsed = parse_encoded_track(content)
+    if parsed is not None:
+        notes, velocities = parsed
+    else:
+        # BytesIO shares the immutable bytes buffer rather than copying it
+        mid = MidiFile(file=io.BytesIO(content))
+        
+        # Extract original data from first track
+        if not mid.tracks:
+            raise HTTPException(status_code=400, detail="MIDI file has no tracks")
         
-        time = msg.time
+        track = mid.tracks[0]
+        
+        # Gather note data in one pass, then reverse the encoding vectorized
+        note_ons = [msg for msg in track if msg.type == 'note_on']
+        notes = np.fromiter((msg.note for msg in note_ons), dtype=np.int16, count=len(note_ons))
+        velocities = np.fromiter((msg.velocity for msg in note_ons), dtype=np.int16, count=len(note_ons))
+    return notes_to_bytes(notes, velocities)
+
+def encode_qr_png(content: bytes, filename: str, file_hash: str) -> bytes:
+    """Encode bytes and their metadata as a QR code PNG"""
+    # Encode file content to base64
+    data_to_encode = {
+        "filename": filename,
+        "hash": file_hash,
+        "data": b64encode_str(content)
+    }
+    
+    # Create QR code
+    qr = qrcode.QRCode(
+        version=None,  # Auto-determine version
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    
+    # orjson emits compact UTF-8 bytes, which qrcode encodes as-is
+    qr.add_data(orjson.dumps(data_to_encode))
+    qr.make(fit=True)
+    
+    # Create QR code image; get_matrix() already includes the border
+    qr_img = qr_matrix_to_image(qr.get_matrix(), qr.box_size)
+    
+    # Save to memory
+    img_buffer = io.BytesIO()
+    qr_img.save(img_buffer, format='PNG')
+    return img_buffer.getvalue()
+
+def decode_qr_png(image_data: bytes) -> tuple[bytes, str, str]:
+    """Read a QR code image, returning the file data, filename and original hash"""
+    image = Image.open(io.BytesIO(image_data)).convert('L')
+    
+    # Decode QR code; raw 8-bit grayscale pixels skip pyzbar's PIL
+    # conversion, and only the QR symbology is scanned for
+    decoded_objects = pyzbar.decode(
+        (image.tobytes(), image.width, image.height),
+        symbols=[pyzbar.ZBarSymbol.QRCODE]
+    )
+    if not decoded_objects:
+        raise HTTPException(status_code=400, detail="No QR code found in image")
+    
+    # Parse QR data
+    qr_text = decoded_objects[0].data
+    
+    # Try different character encodings
+    try:
+        qr_string = qr_text.decode('utf-8')
+    except UnicodeDecodeError:
+        try:
+            qr_string = qr_text.decode('latin-1')
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="Could not decode QR text encoding")
+    
+    try:
+        data = orjson.loads(qr_string)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid QR code data format")
+    
+    # Extract original file data
+    filename = data.get('filename', 'decoded_file')
+    original_hash = data.get('hash', '')
+    file_data = b64decode(data['data'])
+    
+    return file_data, filename, original_hash
 
 # Health check endpoint
 @app.get("/health")
@@ -178,44 +493,23 @@ async def health_check():
 
 # MIDI Codec Endpoints
 @app.post("/encode/midi")
-async def encode_to_midi(file: UploadFile = File(...), mode: str = "raw"):
+async def encode_to_midi(file: UploadFile = File(...), mode: MidiMode = "raw"):
     """Encode file to MIDI format"""
-    content = await file.read()
-    if not content:
-        raise HTTPException(status_code=400, detail="File is empty")
-    
-    # Create MIDI file
-    mid = MidiFile()
-    track = MidiTrack()
-    mid.tracks.append(track)
-    
-    # Convert each byte to MIDI notes
-    for i, byte in enumerate(content):
-        # Map byte (0-255) to MIDI notes (48-111, C3-D#7)
-        note = 48 + (byte % 64)  # Limit to 64 note range
-        velocity = max(40, min(127, 40 + (byte >> 2)))  # Variable velocity
-        time = 120 if i > 0 else 0  # 120 ticks between notes
-        
-        track.append(Message('note_on', note=note, velocity=velocity, time=time))
-        track.append(Message('note_off', note=note, velocity=velocity, time=120))
+    content, file_hash = await read_upload(file)
     
-    # Add musical enhancement if requested
-    if mode == "musical":
-        add_musical_tracks(mid, track)
+    midi_bytes = encode_midi_bytes(content, mode)
     
-    # Save to memory
-    midi_buffer = io.BytesIO()
-    mid.save(file=midi_buffer)
-    midi_buffer.seek(0)
-    
-    file_hash = calculate_hash(content)
-    headers = {'X-Original-Hash': file_hash}
+    midi_filename = f"encoded_{file.filename or 'file'}.mid"
+    headers = {
+        'X-Original-Hash': file_hash,
+        'Content-Disposition': content_disposition(midi_filename)
+    }
     
-    return StreamingResponse(
-        midi_buffer,
+    # Payload is already in memory; a plain Response avoids per-chunk streaming overhead
+    return Response(
+        content=midi_bytes,
         media_type="audio/midi",
-        headers=headers,
-        filename=f"encoded_{file.filename or 'file'}.mid"
+        headers=headers
     )
 
 @app.post("/decode/midi")
@@ -226,31 +520,13 @@ async def decode_from_midi(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="File is empty")
     
     try:
-        # Parse MIDI file
-        midi_buffer = io.BytesIO(content)
-        mid = MidiFile(file=midi_buffer)
-        
-        # Extract original data from first track
-        if not mid.tracks:
-            raise HTTPException(status_code=400, detail="MIDI file has no tracks")
+        original_bytes = decode_midi_bytes(content)
         
-        track = mid.tracks[0]
-        original_bytes = bytearray()
-        
-        # Extract bytes from MIDI note data
-        for msg in track:
-            if msg.type == 'note_on':
-                # Reverse the encoding: note to byte
-                note_offset = msg.note - 48
-                velocity_part = (msg.velocity - 40) << 2
-                byte_value = (note_offset % 64) + min(192, max(0, velocity_part))
-                original_bytes.append(byte_value % 256)
-        
-        decoded_hash = calculate_hash(bytes(original_bytes))
+        decoded_hash = calculate_hash(original_bytes)
         headers = {'X-Decoded-Hash': decoded_hash}
         
-        return StreamingResponse(
-            io.BytesIO(bytes(original_bytes)),
+        return Response(
+            content=original_bytes,
             media_type="application/octet-stream",
             headers=headers
         )
@@ -259,18 +535,16 @@ async def decode_from_midi(file: UploadFile = File(...)):
 
 # Prime Codec Endpoints
 @app.post("/encode/prime")
-async def encode_to_prime(file: UploadFile = File(...)):
-    """Encode file to prime/decimal string"""
-    content = await file.read()
-    if not content:
-        raise HTTPException(status_code=400, detail="File is empty")
+async def encode_to_prime(file: UploadFile = File(...), representation: PrimeRepresentation = "base64"):
+    """Encode file to prime string (base64, hex or legacy decimal)"""
+    content, file_hash = await read_upload(file)
     
-    file_hash = calculate_hash(content)
     filename = file.filename or "unknown"
-    prime_str = bytes_to_prime_string(content, filename)
+    prime_str = bytes_to_prime_string(content, filename, representation)
     
     result = {
         "prime_string": prime_str,
+        "representation": representation,
         "original_hash": file_hash,
         "original_size": len(content),
         "original_filename": filename,
@@ -293,11 +567,11 @@ async def decode_from_prime(prime_data: dict):
         headers = {
             'X-Decoded-Hash': decoded_hash,
             'X-Decoded-Filename': filename,
-            'Content-Disposition': f'attachment; filename="{filename}"'
+            'Content-Disposition': content_disposition(filename)
         }
         
-        return StreamingResponse(
-            io.BytesIO(original_bytes),
+        return Response(
+            content=original_bytes,
             media_type="application/octet-stream",
             headers=headers
         )
@@ -308,49 +582,18 @@ async def decode_from_prime(prime_data: dict):
 @app.post("/encode/qr")
 async def encode_to_qr(file: UploadFile = File(...)):
     """Encode file to QR code image"""
-    content = await file.read()
-    if not content:
-        raise HTTPException(status_code=400, detail="File is empty")
-    
-    # Check file size limit (500KB)
-    if len(content) > 500 * 1024:
-        raise HTTPException(status_code=400, detail="File too large for QR encoding (max 500KB)")
+    # Size limit is enforced while streaming so oversized uploads stop early
+    content, file_hash = await read_upload(file, max_size=QR_MAX_UPLOAD_BYTES, purpose="QR encoding")
     
-    # Encode file content to base64
-    file_hash = calculate_hash(content)
     filename = file.filename or "unknown"
     
-    data_to_encode = {
-        "filename": filename,
-        "hash": file_hash,
-        "data": base64.b64encode(content).decode('utf-8')
-    }
-    
     try:
-        # Create QR code
-        qr = qrcode.QRCode(
-            version=None,  # Auto-determine version
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        
-        import json
-        qr.add_data(json.dumps(data_to_encode))
-        qr.make(fit=True)
-        
-        # Create QR code image
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Save to memory
-        img_buffer = io.BytesIO()
-        qr_img.save(img_buffer, format='PNG')
-        img_buffer.seek(0)
+        png_bytes = encode_qr_png(content, filename, file_hash)
         
         headers = {'X-Original-Hash': file_hash}
         
-        return StreamingResponse(
-            img_buffer,
+        return Response(
+            content=png_bytes,
             media_type="image/png",
             headers=headers
         )
@@ -358,40 +601,21 @@ async def encode_to_qr(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail=f"Could not create QR code: {str(e)}")
 
 @app.post("/decode/qr")
-async def decode_from_qr(qr_data: QRDecodeRequest):
+async def decode_from_qr(request: Request):
     """Decode QR code image back to original file"""
+    # Parse the JSON body in a single msgspec pass instead of json + pydantic
     try:
-        # Decode base64 image
-        image_data = base64.b64decode(qr_data.image_data.split(',')[1] if ',' in qr_data.image_data else qr_data.image_data)
-        image = Image.open(io.BytesIO(image_data))
-        
-        # Decode QR code
-        decoded_objects = pyzbar.decode(image)
-        if not decoded_objects:
-            raise HTTPException(status_code=400, detail="No QR code found in image")
-        
-        # Parse QR data
-        qr_text = decoded_objects[0].data
-        
-        # Try different character encodings
-        try:
-            qr_string = qr_text.decode('utf-8')
-        except UnicodeDecodeError:
-            try:
-                qr_string = qr_text.decode('latin-1')
-            except UnicodeDecodeError:
-                raise HTTPException(status_code=400, detail="Could not decode QR text encoding")
-        
-        try:
-            import json
-            data = json.loads(qr_string)
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=400, detail="Invalid QR code data format")
-        
-        # Extract original file data
-        filename = data.get('filename', 'decoded_file')
-        original_hash = data.get('hash', '')
-        file_data = base64.b64decode(data['data'])
+        qr_data = msgspec.json.decode(await request.body(), type=QRDecodeRequest)
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        raise HTTPException(status_code=422, detail=f"Invalid request body: {str(e)}")
+    
+    try:
+        # Decode base64 image, stripping a data URL prefix (data:image/png;base64,)
+        payload = qr_data.image_data
+        if payload.startswith('data:'):
+            payload = payload[payload.find(',') + 1:]
+        image_data = b64decode(payload)
+        file_data, filename, original_hash = decode_qr_png(image_data)
         
         # Verify integrity
         decoded_hash = calculate_hash(file_data)
@@ -400,11 +624,11 @@ async def decode_from_qr(qr_data: QRDecodeRequest):
             'X-Decoded-Hash': decoded_hash,
             'X-Original-Hash': original_hash,
             'X-Decoded-Filename': filename,
-            'Content-Disposition': f'attachment; filename="{filename}"'
+            'Content-Disposition': content_disposition(filename)
         }
         
-        return StreamingResponse(
-            io.BytesIO(file_data),
+        return Response(
+            content=file_data,
             media_type="application/octet-stream",
             headers=headers
         )
@@ -415,33 +639,149 @@ async def decode_from_qr(qr_data: QRDecodeRequest):
 @app.post("/verify")
 async def verify_hashes(verification: VerificationRequest):
     """Verify if original and decoded hashes match"""
-    match = verification.original_hash.lower() == verification.decoded_hash.lower()
+    # Constant-time comparison; encode since compare_digest rejects non-ASCII str
+    match = hmac.compare_digest(
+        verification.original_hash.lower().encode('utf-8'),
+        verification.decoded_hash.lower().encode('utf-8')
+    )
     verified = len(verification.original_hash) == 64 and len(verification.decoded_hash) == 64
     
     return VerificationResponse(verified=verified, match=match)
 
 # Pipeline endpoint
+PIPELINE_OPERATION_ALIASES = {
+    'midi': 'encode_midi',
+    'prime': 'encode_prime',
+    'qr': 'encode_qr',
+}
+
+def pipeline_parameter(step: PipelineStep, name: str, choices, default: str) -> str:
+    """Read a step parameter, accepting the same values as its endpoint"""
+    value = step.parameters.get(name, default)
+    allowed = get_args(choices)
+    if not isinstance(value, str) or value not in allowed:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} for {step.operation}: {value!r} (expected one of {', '.join(allowed)})")
+    return value
+
+def apply_pipeline_operation(step: PipelineStep, data: bytes, filename: str, data_hash: str) -> tuple[bytes, str]:
+    """Apply one pipeline operation, returning its output bytes and filename"""
+    operation = PIPELINE_OPERATION_ALIASES.get(step.operation, step.operation)
+    
+    if operation == 'encode_midi':
+        mode = pipeline_parameter(step, 'mode', MidiMode, 'raw')
+        return encode_midi_bytes(data, mode), f"encoded_{filename}.mid"
+    if operation == 'decode_midi':
+        return decode_midi_bytes(data), filename
+    if operation == 'encode_prime':
+        representation = pipeline_parameter(step, 'representation', PrimeRepresentation, 'base64')
+        prime_str = bytes_to_prime_string(data, filename, representation)
+        return prime_str.encode('ascii'), f"encoded_{filename}.txt"
+    if operation == 'decode_prime':
+        return prime_string_to_bytes(data.decode('ascii'))
+    if operation == 'encode_qr':
+        if len(data) > QR_MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=400, detail=f"Input too large for QR encoding (max {QR_MAX_UPLOAD_BYTES // 1024}KB)")
+        return encode_qr_png(data, filename, data_hash), f"encoded_{filename}.png"
+    if operation == 'decode_qr':
+        file_data, decoded_filename, _ = decode_qr_png(data)
+        return file_data, decoded_filename
+    
+    raise HTTPException(status_code=400, detail=f"Unknown pipeline operation: {step.operation}")
+
+def run_pipeline_step(step: PipelineStep, data: bytes, filename: str, data_hash: str) -> tuple[bytes, str, str]:
+    """Run one pipeline step, also hashing its output for the steps it feeds"""
+    output, output_filename = apply_pipeline_operation(step, data, filename, data_hash)
+    return output, output_filename, calculate_hash(output)
+
+def pipeline_inputs(steps: List[PipelineStep]) -> List[int]:
+    """Resolve the index of the step feeding each step (-1 for the upload)"""
+    inputs = []
+    for i, step in enumerate(steps):
+        source = i - 1 if step.input is None else step.input
+        if not -1 <= source < i:
+            raise HTTPException(status_code=400, detail=f"Step {i} has invalid input {step.input}")
+        inputs.append(source)
+    return inputs
+
+async def run_pipeline_graph(
+    steps: List[PipelineStep],
+    inputs: List[int],
+    upload: tuple[bytes, str, str],
+) -> List[tuple[bytes, str, str]]:
+    """Run each step in a worker thread as soon as its own input is ready.
+    
+    Every output is (data, filename, hash), so each digest is computed once
+    and travels with its bytes. Raises the first failing step's error.
+    """
+    tasks: List[asyncio.Task] = []
+    
+    async def run_step(i: int) -> tuple[bytes, str, str]:
+        source = inputs[i]
+        data = upload if source == -1 else await tasks[source]
+        return await to_thread.run_sync(run_pipeline_step, steps[i], *data)
+    
+    # Inputs always point at earlier steps, so each source task already exists
+    for i in range(len(steps)):
+        tasks.append(asyncio.create_task(run_step(i)))
+    
+    # Wait for every branch so no failure goes unretrieved; a failed step's
+    # dependents re-raise its error, so the earliest failure is the cause
+    outputs = await asyncio.gather(*tasks, return_exceptions=True)
+    for output in outputs:
+        if isinstance(output, BaseException):
+            raise output
+    return outputs
+
+def parse_pipeline_steps(pipeline: Optional[str], header_steps: Optional[str]) -> List[PipelineStep]:
+    """Read steps from the pipeline form field, or the X-Pipeline-Steps header"""
+    if pipeline:
+        try:
+            return PipelineRequest(**orjson.loads(pipeline)).steps
+        except (orjson.JSONDecodeError, TypeError, ValidationError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid pipeline: {str(e)}")
+    if header_steps:
+        return [PipelineStep(operation=name.strip()) for name in header_steps.split(',') if name.strip()]
+    raise HTTPException(status_code=400, detail="No pipeline steps provided")
+
 @app.post("/pipeline")
-async def process_pipeline(pipeline: PipelineRequest, file: UploadFile = File(...)):
-    """Process file through multiple encoding/decoding steps"""
-    current_data = await file.read()
-    current_filename = file.filename or "unknown"
+async def process_pipeline(
+    file: UploadFile = File(...),
+    pipeline: Optional[str] = Form(None),
+    x_pipeline_steps: Optional[str] = Header(None),
+):
+    """Process file through multiple encoding/decoding steps.
     
-    results = []
+    Each step starts as soon as the step feeding it finishes, so independent
+    branches (e.g. several encodings of the same input) run concurrently in
+    worker threads.
+    """
+    steps = parse_pipeline_steps(pipeline, x_pipeline_steps)
+    content, file_hash = await read_upload(file)
+    inputs = pipeline_inputs(steps)
     
     try:
-        for step in pipeline.steps:
-            # This would need implementation for each step type
-            # For now, return a placeholder
-            results.append({
-                "operation": step.operation,
-                "status": "completed",
-                "parameters": step.parameters
-            })
-        
-        return {"steps": results, "status": "completed"}
+        outputs = await run_pipeline_graph(steps, inputs, (content, file.filename or "unknown", file_hash))
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Pipeline processing failed: {str(e)}")
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        raise HTTPException(status_code=400, detail=f"Pipeline processing failed: {detail}")
+    
+    results = []
+    for i, step in enumerate(steps):
+        data, filename, data_hash = outputs[i]
+        results.append({
+            "operation": step.operation,
+            "status": "completed",
+            "parameters": step.parameters,
+            "input": inputs[i],
+            "output_filename": filename,
+            "output_size": len(data),
+            "output_hash": data_hash
+        })
+    
+    return JSONResponse(
+        content={"steps": results, "status": "completed"},
+        headers={'X-Original-Hash': file_hash}
+    )
 
 if __name__ == "__main__":
     import uvicorn